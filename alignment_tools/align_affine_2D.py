@@ -2,7 +2,7 @@ from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QPushButton, 
     QTableWidget, QTableWidgetItem, QHeaderView, 
     QFrame, QGroupBox)
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 import cv2
 import numpy as np
 from qt_widgets import LabeledDoubleSpinBox
@@ -10,6 +10,18 @@ from image_tools import im2single, im2uint8, im2gray, ControlPoint, Enhance, Ima
 import ants
 
 
+def to_gray_uint8(image: np.ndarray) -> np.ndarray:
+    # normalize input to 8-bit grayscale. Images straight from cv2.imread are
+    # already uint8, skip the float32 round-trip for those. The copy makes the
+    # result contiguous (a single channel of a color image is a strided view,
+    # which the warp would otherwise recopy per call) and keeps the widget's
+    # buffer private from the caller's
+
+    if image.ndim == 2 and image.dtype == np.uint8:
+        return image.copy()
+    return im2uint8(im2gray(im2single(image)))
+
+
 def affine_transformation_matrix_to_params(A: np.ndarray):
     '''
     Decompose affine transformation into shear, rotation, scaling and translation
@@ -60,11 +72,26 @@ class AlignAffine2D(QWidget):
         
         super().__init__(*args, **kwargs)
 
-        self.moving = im2uint8(im2gray(im2single(moving)))
-        self.fixed = im2uint8(im2gray(im2single(fixed)))
-        self.moving_transformed = self.moving
-        self.overlay = np.dstack((self.fixed,np.zeros_like(self.fixed),np.zeros_like(self.fixed)))
+        self.moving = to_gray_uint8(moving)
+        self.fixed = to_gray_uint8(fixed)
         self.affine_transform = np.eye(3,dtype=float)
+
+        # preallocate the warp output and overlay once, render_images reuses
+        # them instead of allocating new arrays on every slider event
+        h, w = self.fixed.shape[:2]
+        self.moving_transformed = cv2.warpAffine(self.moving, self.affine_transform[:2,:], (w,h))
+        self.overlay = np.zeros((h,w,3), dtype=np.uint8)
+        self.overlay[:,:,0] = self.fixed
+
+        # run the warp through OpenCV's T-API (OpenCL) when a device is there.
+        # The source image is uploaded once, only the result is downloaded
+        self.use_opencl = cv2.ocl.haveOpenCL()
+        if self.use_opencl:
+            self.moving_umat = cv2.UMat(self.moving)
+
+        # what the overlay currently shows, to skip redundant renders
+        self.rendered_transform = None
+        self.rendered_interpolation = None
         self.create_components()
         self.layout_components()
         self.setWindowTitle("Registration2D")
@@ -167,6 +194,18 @@ class AlignAffine2D(QWidget):
         self.align_auto.setText('Align automatically')
         self.align_auto.clicked.connect(self.align_automatically)
 
+        # coalesce bursts of valueChanged events into a single redraw
+        self.update_timer = QTimer(self)
+        self.update_timer.setSingleShot(True)
+        self.update_timer.setInterval(16)
+        self.update_timer.timeout.connect(self.render_preview)
+
+        # full-quality warp once the user stops changing parameters
+        self.refine_timer = QTimer(self)
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.setInterval(200)
+        self.refine_timer.timeout.connect(self.render_images)
+
     def layout_components(self):
         
         layout_params = QVBoxLayout(self.transformation_groupbox)
@@ -197,13 +236,40 @@ class AlignAffine2D(QWidget):
         self.overlay_label.setWindowTitle("overlay")
 
     def update_images(self):
+        # schedule a redraw. Dragging a spinbox fires valueChanged on every
+        # step, the timer makes sure only the last value triggers the warp
+
+        self.update_timer.start()
+
+    def render_preview(self):
+        # cheap nearest-neighbour warp while parameters are still moving,
+        # schedule a bilinear pass for when they settle
+
+        self.render_images(cv2.INTER_NEAREST)
+        self.refine_timer.start()
+
+    def render_images(self, interpolation: int = cv2.INTER_LINEAR):
         # update overlay image
 
+        # a full-quality render of this transform also satisfies a
+        # nearest-neighbour preview request, don't downgrade and re-refine
+        if (np.array_equal(self.affine_transform, self.rendered_transform)
+            and self.rendered_interpolation in (interpolation, cv2.INTER_LINEAR)):
+            return
+
         h, w = self.fixed.shape[:2]
-        self.moving_transformed = cv2.warpAffine(self.moving, self.affine_transform[:2,:], (w,h))
-        self.overlay = np.dstack((self.fixed,self.moving_transformed,np.zeros_like(self.fixed)))
-        self.overlay_label.set_image(self.overlay) 
-        self.overlay_label.reset_transform()
+        if self.use_opencl:
+            warped = cv2.warpAffine(self.moving_umat, self.affine_transform[:2,:], (w,h), flags=interpolation)
+            self.moving_transformed[:] = warped.get()
+        else:
+            cv2.warpAffine(self.moving, self.affine_transform[:2,:], (w,h), dst=self.moving_transformed, flags=interpolation)
+
+        # red and blue channels never change, only rewrite the warped green one
+        self.overlay[:,:,1] = self.moving_transformed
+        self.overlay_label.set_image(self.overlay)
+
+        self.rendered_transform = self.affine_transform.copy()
+        self.rendered_interpolation = interpolation
 
     def update_spinboxes(self, s_x, s_y, theta, h_x, t_x, t_y):
         # update values without triggering callbacks
@@ -237,13 +303,14 @@ class AlignAffine2D(QWidget):
         self.translate_y.blockSignals(False)
 
     def update_table(self):
-        # update values without triggering callbacks
+        # update values without triggering callbacks. Reuse the items created
+        # in create_components instead of replacing them on every update
 
+        self.transformation_matrix_table.blockSignals(True)
         for i in range(3):
             for j in range(3):
-                self.transformation_matrix_table.blockSignals(True)
-                self.transformation_matrix_table.setItem(i,j,QTableWidgetItem(f'{self.affine_transform[i,j]:2f}'))
-                self.transformation_matrix_table.blockSignals(False)
+                self.transformation_matrix_table.item(i,j).setText(f'{self.affine_transform[i,j]:2f}')
+        self.transformation_matrix_table.blockSignals(False)
 
     def callback_table(self, row: int, col: int):
 
@@ -267,34 +334,25 @@ class AlignAffine2D(QWidget):
         sc_x = self.scale_x.value()
         sc_y = self.scale_y.value()
 
-        H = np.array([[ 1.0, sh_x,   0],
-                    [sh_y,  1.0,   0],
-                    [   0,    0, 1.0]])
-        
-        R = np.array([[c, -s,   0],
-                    [s,  c,   0],
-                    [0,  0, 1.0]])
-
-        S = np.array([[sc_x,    0,   0],
-                    [0,    sc_y,   0],
-                    [0,       0, 1.0]])
-        
-        T = np.array([[1.0,   0, t_x],
-                    [0,   1.0, t_y],
-                    [0,     0, 1.0]])
-
-        self.affine_transform = T @ R @ H @ S
+        # closed-form expansion of Translation @ Rotation @ Shear @ Scale,
+        # avoids building four 3x3 matrices and chaining matmuls per event
+        self.affine_transform = np.array(
+            [[sc_x*(c - s*sh_y), sc_y*(c*sh_x - s), t_x],
+             [sc_x*(s + c*sh_y), sc_y*(s*sh_x + c), t_y],
+             [                0,                 0, 1.0]]
+        )
 
         self.update_table()
         self.update_images()
 
     def align_control_points(self):
 
-        # find affine transformation between two sets of points
-        a = [[pos.x(), pos.y(), 1] for pos in self.fixed_cp.control_points]
-        b = [[pos.x(), pos.y(), 1] for pos in self.moving_cp.control_points]
-        A = np.transpose(np.linalg.lstsq(b, a, rcond=None)[0])
-        self.affine_transform = A
+        # find affine transformation between two sets of points. Solve for the
+        # 2x3 part only, the homogeneous row is [0, 0, 1] by construction
+        a = np.array([[pos.x(), pos.y()] for pos in self.fixed_cp.control_points])
+        b = np.array([[pos.x(), pos.y(), 1.0] for pos in self.moving_cp.control_points])
+        self.affine_transform = np.eye(3)
+        self.affine_transform[:2,:] = np.linalg.lstsq(b, a, rcond=None)[0].T
 
         # update GUI
         (s_x, s_y, theta, h_x, t_x, t_y) = affine_transformation_matrix_to_params(self.affine_transform)